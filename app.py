@@ -3,17 +3,22 @@ import streamlit.components.v1 as components
 import numpy as np
 import librosa
 import soundfile as sf
-import matplotlib.pyplot as plt
-from scipy import signal
+from matplotlib.figure import Figure
+from scipy.ndimage import uniform_filter1d
 import io
 import os
+import datetime
+import fcntl
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from services.audio_processor import AudioProcessor
 from services.speaker_separator import SpeakerSeparator
 from services.transcribe_service import transcribe_streamlit
 
+# Target number of points for the Tab 4 speaker timeline
+TIMELINE_POINTS = 2000
 
 st.markdown("""
 <style>
@@ -55,6 +60,7 @@ for key, default in [
     ("dia_turns", None),
     ("dia_script", None),
     ("dia_session_name", None),
+    ("figures", {}),
 ]:
     if key not in st.session_state:
         st.session_state[key] = default
@@ -62,28 +68,134 @@ for key, default in [
 # ==============================
 # Helper: session folder for SPEAKER separation
 # ==============================
+def next_speaker_session_number(base_dir):
+    """Atomically bump saved_speaker/.counter; safe across processes."""
+    fd = os.open(os.path.join(base_dir, ".counter"), os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        raw = os.read(fd, 32).strip()
+        if raw:
+            session_num = int(raw) + 1
+        else:
+            # first use: continue numbering after any pre-counter sessions
+            existing = [d for d in os.listdir(base_dir) if d.startswith("session_")]
+            session_num = len(existing) + 1
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, str(session_num).encode())
+    finally:
+        os.close(fd)  # releases the lock
+    return session_num
+
 def create_speaker_session_folder():
     base_dir = "saved_speaker"
     os.makedirs(base_dir, exist_ok=True)
 
-    existing = [d for d in os.listdir(base_dir) if d.startswith("session_")]
-    session_num = len(existing) + 1
-
-    date_str = Path(tempfile.gettempdir()).stat().st_mtime  # not needed, use datetime
-    import datetime as _dt
-    date_str = _dt.datetime.now().strftime("%Y-%m-%d")
+    session_num = next_speaker_session_number(base_dir)
+    date_str = datetime.datetime.now().strftime("%Y-%m-%d")
 
     session_folder = os.path.join(base_dir, f"session_{session_num:03d}_{date_str}")
     os.makedirs(session_folder, exist_ok=True)
     return session_folder
 
+# ==============================
+# Helper: decode uploaded audio to mono
+# ==============================
+SOUNDFILE_EXTENSIONS = {".wav", ".flac", ".ogg"}
+
+def downmix_to_mono(audio):
+    """Average channels-first (C, N) audio to (N,) without a float64 temporary."""
+    if audio.shape[0] == 2:
+        mono = np.add(audio[0], audio[1], dtype=audio.dtype)
+        mono *= 0.5
+    else:
+        mono = audio.sum(axis=0, dtype=audio.dtype)
+        mono /= audio.shape[0]
+    return mono
+
+def load_audio_mono(path, ext):
+    """Decode with soundfile where libsndfile can, falling back to librosa (mp3/m4a)."""
+    if ext in SOUNDFILE_EXTENSIONS:
+        try:
+            audio, sr = sf.read(path, dtype="float32", always_2d=False)
+            if audio.ndim == 2:
+                # soundfile is channels-last
+                audio = downmix_to_mono(audio.T)
+            return audio, sr
+        except sf.LibsndfileError:
+            pass
+
+    audio, sr = librosa.load(path, sr=None, mono=False)
+    if audio.ndim > 1:
+        audio = downmix_to_mono(audio)
+    return audio, sr
+
+# ==============================
+# Helper: cached WAV encoding for playback + download
+# ==============================
+# a few uploads x up to 6 speakers
+@st.cache_data(max_entries=18)
+def encode_wav(audio: np.ndarray, sr: int) -> bytes:
+    buf = io.BytesIO()
+    sf.write(buf, audio, sr, format="WAV")
+    return buf.getvalue()
+
+# ==============================
+# Helper: cached spectrogram for Tab 4
+# ==============================
+# each entry is an O(file) dB matrix; keep only the most recent uploads
+@st.cache_data(max_entries=2)
+def compute_spectrogram(audio: np.ndarray, sr: int) -> np.ndarray:
+    stft = librosa.stft(audio, n_fft=2048, hop_length=512)
+    return librosa.amplitude_to_db(np.abs(stft), ref=np.max)
+
+# ==============================
+# Helper: min/max decimation so matplotlib draws ~screen resolution
+# ==============================
+def decimate_for_plot(y, max_points=4000):
+    n = len(y)
+    if n <= max_points:
+        return y
+    bins = max_points // 2
+    stride = n // bins
+    binned = y[: bins * stride].reshape(bins, stride)
+    lo = binned.min(axis=1)
+    hi = binned.max(axis=1)
+    # fold the trailing n % bins samples into the last bin so the whole duration is covered
+    tail = y[bins * stride:]
+    if len(tail):
+        lo[-1] = min(lo[-1], tail.min())
+        hi[-1] = max(hi[-1], tail.max())
+    # interleave each bin's min and max to keep the waveform envelope
+    return np.stack([lo, hi], axis=1).ravel()
+
+# ==============================
+# Helper: reusable per-session matplotlib figures
+# ==============================
+def get_fig(key, figsize):
+    """Return a cleared (fig, ax) kept in session state, creating it on first use."""
+    figures = st.session_state.figures
+    if key not in figures:
+        fig = Figure(figsize=figsize)
+        figures[key] = (fig, fig.subplots())
+    fig, ax = figures[key]
+    # drop extra axes such as colorbars from the previous render
+    for extra in fig.axes[1:]:
+        extra.remove()
+    ax.clear()
+    return fig, ax
+
 # ==============================
 # Sidebar
 # ==============================
 st.sidebar.header("⚙️ Separation Settings")
 noise_reduction = st.sidebar.checkbox("Enable Noise Reduction", value=True)
 normalize_audio = st.sidebar.checkbox("Normalize Audio", value=True)
-num_speakers = st.sidebar.slider("Expected Number of Speakers", 2, 6, 2)
+num_speakers = st.sidebar.slider(
+    "Expected Number of Speakers", 2, 6, 2,
+    help="Tracks follow the diarized speakers; this count drives separation only when "
+         "diarization finds no turns, and otherwise is checked against the diarized count.",
+)
 
 st.sidebar.markdown("---")
 st.sidebar.markdown("### About")
@@ -115,13 +227,14 @@ with tab1:
 
     if uploaded_file is not None:
         st.success(f"✅ File uploaded: {uploaded_file.name}")
+        raw_bytes = uploaded_file.getvalue()
 
         col1, col2 = st.columns([2, 1])
         with col1:
             st.audio(uploaded_file)
 
         with col2:
-            st.metric("File Size", f"{len(uploaded_file.getvalue()) / (1024*1024):.2f} MB")
+            st.metric("File Size", f"{len(raw_bytes) / (1024*1024):.2f} MB")
 
         if st.button("🚀 Run Separation + Diarization", type="primary", use_container_width=True):
             with st.spinner("Processing audio..."):
@@ -133,18 +246,25 @@ with tab1:
                     status_text.text("Saving temporary audio file...")
                     progress_bar.progress(10)
 
-                    raw_bytes = uploaded_file.getvalue()
                     with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp_file:
                         tmp_file.write(raw_bytes)
                         tmp_path = tmp_file.name
 
+                    # --------- Diarization + transcription ----------
+                    # runs first so its turns can drive the separation below
+                    status_text.text("Running diarization + transcription...")
+                    progress_bar.progress(25)
+
+                    dia_result = transcribe_streamlit(tmp_path)
+                    st.session_state.dia_turns = dia_result.get("transcription", [])
+                    st.session_state.dia_script = dia_result.get("formatted_script", "")
+                    st.session_state.dia_session_name = dia_result.get("session", "")
+
                     # --------- Load audio for separation pipeline ----------
                     status_text.text("Loading & preprocessing for separation...")
-                    progress_bar.progress(25)
+                    progress_bar.progress(60)
 
-                    audio, sr = librosa.load(tmp_path, sr=None, mono=False)
-                    if audio.ndim > 1:
-                        audio = np.mean(audio, axis=0)
+                    audio, sr = load_audio_mono(tmp_path, Path(uploaded_file.name).suffix.lower())
 
                     st.session_state.original_audio = audio
                     st.session_state.sample_rate = sr
@@ -159,34 +279,41 @@ with tab1:
 
                     # --------- Speaker separation ----------
                     status_text.text("Running speaker separation...")
-                    progress_bar.progress(45)
+                    progress_bar.progress(75)
 
+                    # diarized turns give the speaker timeline; blind clustering is only a fallback
                     separator = SpeakerSeparator(sr, num_speakers=num_speakers)
-                    separated_speakers = separator.separate_speakers(processed)
+                    separated_speakers = separator.separate_speakers(
+                        processed, prior_turns=st.session_state.dia_turns
+                    )
                     st.session_state.separated_speakers = separated_speakers
 
+                    if st.session_state.dia_turns and len(separated_speakers) != num_speakers:
+                        st.warning(
+                            f"⚠️ Diarization found {len(separated_speakers)} speakers, "
+                            f"but {num_speakers} were expected; tracks follow the diarization."
+                        )
+
                     # Save separated session to saved_speaker/
                     ses_folder = create_speaker_session_folder()
 
-                    # Save original audio
-                    orig_path = os.path.join(ses_folder, "original_audio.wav")
-                    sf.write(orig_path, st.session_state.original_audio, st.session_state.sample_rate)
-
-                    # Save separated speakers
-                    for i, (speaker_label, speaker_audio) in enumerate(
-                        st.session_state.separated_speakers.items(), 1
-                    ):
-                        file_path = os.path.join(ses_folder, f"speaker_{i}.wav")
-                        sf.write(file_path, speaker_audio, st.session_state.sample_rate)
-
-                    # --------- Diarization + transcription ----------
-                    status_text.text("Running diarization + transcription...")
-                    progress_bar.progress(75)
-
-                    dia_result = transcribe_streamlit(raw_bytes)
-                    st.session_state.dia_turns = dia_result.get("transcription", [])
-                    st.session_state.dia_script = dia_result.get("formatted_script", "")
-                    st.session_state.dia_session_name = dia_result.get("session", "")
+                    # Save original + separated speakers as float32 WAVs; libsndfile
+                    # releases the GIL, so the writes overlap
+                    status_text.text("Saving session audio...")
+                    progress_bar.progress(90)
+
+                    with ThreadPoolExecutor(max_workers=4) as ex:
+                        orig_path = os.path.join(ses_folder, "original_audio.wav")
+                        futures = [
+                            ex.submit(sf.write, orig_path, st.session_state.original_audio, sr, subtype="FLOAT")
+                        ]
+                        for i, (speaker_label, speaker_audio) in enumerate(
+                            st.session_state.separated_speakers.items(), 1
+                        ):
+                            file_path = os.path.join(ses_folder, f"speaker_{i}.wav")
+                            futures.append(ex.submit(sf.write, file_path, speaker_audio, sr, subtype="FLOAT"))
+                        for fut in futures:
+                            fut.result()
 
                     # Cleanup temp
                     os.unlink(tmp_path)
@@ -217,20 +344,16 @@ with tab2:
             with st.expander(f"🎤 Speaker {idx}", expanded=True):
                 col1, col2 = st.columns([3, 1])
 
+                wav_bytes = encode_wav(speaker_audio, sr)
+
                 with col1:
-                    audio_bytes = io.BytesIO()
-                    sf.write(audio_bytes, speaker_audio, sr, format="WAV")
-                    audio_bytes.seek(0)
-                    st.audio(audio_bytes, format="audio/wav")
+                    st.audio(wav_bytes, format="audio/wav")
 
                 with col2:
                     duration = len(speaker_audio) / sr
                     st.metric("Duration", f"{duration:.1f}s")
                     st.metric("Samples", f"{len(speaker_audio):,}")
 
-                    wav_bytes = io.BytesIO()
-                    sf.write(wav_bytes, speaker_audio, sr, format="WAV")
-                    wav_bytes.seek(0)
                     st.download_button(
                         label="⬇️ Download WAV",
                         data=wav_bytes,
@@ -239,15 +362,15 @@ with tab2:
                         use_container_width=True,
                     )
 
-                fig, ax = plt.subplots(figsize=(10, 2))
-                time = np.linspace(0, duration, len(speaker_audio))
-                ax.plot(time, speaker_audio, linewidth=0.5)
+                fig, ax = get_fig(f"speaker_waveform_{idx}", (10, 2))
+                plot_y = decimate_for_plot(speaker_audio)
+                time = np.linspace(0, duration, len(plot_y))
+                ax.plot(time, plot_y, linewidth=0.5)
                 ax.set_xlabel("Time (s)")
                 ax.set_ylabel("Amplitude")
                 ax.set_title(f"Speaker {idx} Waveform")
                 ax.grid(True, alpha=0.3)
-                st.pyplot(fig)
-                plt.close()
+                st.pyplot(fig, clear_figure=False)
 
         st.markdown("---")
         col1, col2, col3 = st.columns(3)
@@ -322,25 +445,26 @@ with tab4:
 
         with col1:
             st.subheader("Original Audio Waveform")
-            fig, ax = plt.subplots(figsize=(10, 4))
-            time = np.linspace(0, len(audio) / sr, len(audio))
-            ax.plot(time, audio, linewidth=0.5)
+            fig, ax = get_fig("original_waveform", (10, 4))
+            plot_y = decimate_for_plot(audio)
+            time = np.linspace(0, len(audio) / sr, len(plot_y))
+            ax.plot(time, plot_y, linewidth=0.5)
             ax.set_xlabel("Time (s)")
             ax.set_ylabel("Amplitude")
             ax.set_title("Full Audio Waveform")
             ax.grid(True, alpha=0.3)
-            st.pyplot(fig)
-            plt.close()
+            st.pyplot(fig, clear_figure=False)
 
         with col2:
             st.subheader("Spectrogram")
-            fig, ax = plt.subplots(figsize=(10, 4))
-            D = librosa.amplitude_to_db(np.abs(librosa.stft(audio)), ref=np.max)
-            img = librosa.display.specshow(D, sr=sr, x_axis="time", y_axis="hz", ax=ax, cmap="viridis")
+            fig, ax = get_fig("spectrogram", (10, 4))
+            D = compute_spectrogram(audio, sr)
+            img = librosa.display.specshow(
+                D, sr=sr, hop_length=512, x_axis="time", y_axis="hz", ax=ax, cmap="viridis"
+            )
             ax.set_title("Spectrogram")
             fig.colorbar(img, ax=ax, format="%+2.0f dB")
-            st.pyplot(fig)
-            plt.close()
+            st.pyplot(fig, clear_figure=False)
 
         col1, col2, col3 = st.columns(3)
         with col1:
@@ -354,12 +478,18 @@ with tab4:
             st.markdown("---")
             st.subheader("Speaker Activity Timeline (Separation)")
 
-            fig, ax = plt.subplots(figsize=(12, 6))
+            fig, ax = get_fig("speaker_timeline", (12, 6))
+
+            # All separated tracks share the mixture's length: hoist the axis and buffer
+            first_spk = next(iter(st.session_state.separated_speakers.values()))
+            hop = max(1, len(first_spk) // TIMELINE_POINTS)
+            energy = np.empty_like(first_spk[::hop])
+            time = np.linspace(0, len(first_spk) / sr, len(energy), endpoint=False)
 
             for idx, (speaker_label, speaker_audio) in enumerate(st.session_state.separated_speakers.items(), 1):
-                energy = np.abs(speaker_audio)
-                smoothed = signal.medfilt(energy, kernel_size=2001)
-                time = np.linspace(0, len(speaker_audio) / sr, len(speaker_audio))
+                # Box-filtered envelope at ~screen resolution instead of a full-rate median
+                np.abs(speaker_audio[::hop], out=energy)
+                smoothed = uniform_filter1d(energy, size=max(1, 2001 // hop))
                 ax.plot(time, smoothed + (idx - 1) * 0.3, label=f"Speaker {idx}", linewidth=1)
 
             ax.set_xlabel("Time (s)")
@@ -367,8 +497,7 @@ with tab4:
             ax.set_title("Speaker Activity Timeline (Separated)")
             ax.legend()
             ax.grid(True, alpha=0.3)
-            st.pyplot(fig)
-            plt.close()
+            st.pyplot(fig, clear_figure=False)
     else:
         st.info("👆 Upload and process an audio file to see detailed analysis here.")
 
@@ -1,32 +1,70 @@
-def assign_speaker_to_words(words, speaker_segments, margin=0.3):
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def _assign_segments(word_start, word_end, seg_start, seg_end, margin):
+    """For each word, index of the first segment it falls in (with margin), else the closest start."""
+    n = word_start.shape[0]
+    num_segs = seg_start.shape[0]
+    out = np.empty(n, dtype=np.int64)
+    for i in prange(n):
+        ws = word_start[i]
+        we = word_end[i]
+        hit = -1
+        for j in range(num_segs):
+            lo = seg_start[j] - margin
+            hi = seg_end[j] + margin
+            if (lo <= ws <= hi) or (lo <= we <= hi):
+                hit = j
+                break
+        if hit == -1:
+            best = abs(seg_start[0] - ws)
+            hit = 0
+            for j in range(1, num_segs):
+                d = abs(seg_start[j] - ws)
+                if d < best:
+                    best = d
+                    hit = j
+        out[i] = hit
+    return out
+
+
+def assign_speaker_to_words(starts, ends, words, speaker_segments, margin=0.3):
     """
     Assign each transcribed word to the nearest diarized speaker segment.
     Handles small gaps and timing offsets.
+    Words come in as parallel arrays (starts, ends, words).
     """
-    result = []
-    for word in words:
-        w_start = word.get("start", 0)
-        w_end = word.get("end", 0)
-        w_text = word.get("word", "")
-
-        speaker = "Unknown"
-        for seg in speaker_segments:
-            if (seg["start"] - margin <= w_start <= seg["end"] + margin) or \
-               (seg["start"] - margin <= w_end <= seg["end"] + margin):
-                speaker = seg["speaker"]
-                break
+    n = len(words)
+    if not speaker_segments:
+        speakers = ["Unknown"] * n
+    else:
+        seg_start = np.array([seg["start"] for seg in speaker_segments], dtype=np.float64)
+        seg_end = np.array([seg["end"] for seg in speaker_segments], dtype=np.float64)
+        labels, seg_spk = np.unique(
+            np.array([seg["speaker"] for seg in speaker_segments]), return_inverse=True
+        )
+        seg_spk = seg_spk.astype(np.int32)
 
-        if speaker == "Unknown" and speaker_segments:
-            closest = min(speaker_segments, key=lambda s: abs(s["start"] - w_start))
-            speaker = closest["speaker"]
+        chosen = _assign_segments(
+            np.asarray(starts, dtype=np.float64),
+            np.asarray(ends, dtype=np.float64),
+            seg_start,
+            seg_end,
+            margin,
+        )
+        speakers = [str(labels[seg_spk[j]]) for j in chosen]
 
-        result.append({
-            "speaker": speaker,
-            "start": w_start,
-            "end": w_end,
-            "text": w_text
-        })
-    return result
+    return [
+        {
+            "speaker": speakers[i],
+            "start": float(starts[i]),
+            "end": float(ends[i]),
+            "text": words[i]
+        }
+        for i in range(n)
+    ]
 
 
 def group_words_to_turns(word_segments, merge_gap=0.5):
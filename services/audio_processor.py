@@ -3,27 +3,60 @@ import librosa
 from scipy import signal
 from scipy.ndimage import median_filter
 
+from services.audio_utils import iter_blocks, stitch_blocks
+
 class AudioProcessor:
-    def __init__(self, sample_rate):
+    def __init__(self, sample_rate, block_duration=30.0, overlap_duration=1.0):
         self.sample_rate = sample_rate
+        self.n_fft = 2048
+        self.hop_length = 512
+        self.block_size = int(block_duration * sample_rate)
+        self.overlap = int(overlap_duration * sample_rate)
     
     def preprocess(self, audio, reduce_noise=True, normalize=True):
-        processed = audio.copy()
-        
-        if reduce_noise:
-            processed = self.reduce_noise(processed)
-        
+        blocks = iter_blocks(audio, self.block_size, self.overlap)
+        return self.preprocess_blocks(blocks, reduce_noise=reduce_noise, normalize=normalize)
+    
+    def preprocess_blocks(self, blocks, reduce_noise=True, normalize=True):
+        """
+        Preprocess an iterator of overlapping blocks (as from sf.blocks / iter_blocks)
+        so STFT memory stays O(block) rather than O(file).
+        """
+        noise_profile = None
+        processed_blocks = []
+        
+        for block in blocks:
+            processed = block.copy()
+            
+            if reduce_noise:
+                # the profile comes from the leading frames of the file, as before
+                if noise_profile is None:
+                    noise_profile = self.estimate_noise_profile(processed)
+                processed = self.reduce_noise(processed, noise_profile=noise_profile)
+            
+            processed_blocks.append(processed)
+        
+        processed = np.concatenate(list(stitch_blocks(processed_blocks, self.overlap)))
+        
+        # peak normalization is a single gain, applied once over the stitched signal
         if normalize:
             processed = self.normalize_audio(processed)
         
         return processed
     
-    def reduce_noise(self, audio):
-        stft = librosa.stft(audio)
+    def estimate_noise_profile(self, audio, num_frames=10):
+        # only the leading frames are used, so only transform the samples they cover
+        lead = audio[: self.n_fft + (num_frames - 1) * self.hop_length]
+        magnitude = np.abs(librosa.stft(lead, n_fft=self.n_fft, hop_length=self.hop_length))
+        return np.median(magnitude[:, :num_frames], axis=1, keepdims=True)
+    
+    def reduce_noise(self, audio, noise_profile=None):
+        stft = librosa.stft(audio, n_fft=self.n_fft, hop_length=self.hop_length)
         magnitude = np.abs(stft)
         phase = np.angle(stft)
         
-        noise_profile = np.median(magnitude[:, :10], axis=1, keepdims=True)
+        if noise_profile is None:
+            noise_profile = self.estimate_noise_profile(audio)
         
         threshold = 1.5
         mask = magnitude > (noise_profile * threshold)
@@ -31,7 +64,7 @@ class AudioProcessor:
         cleaned_magnitude = magnitude * mask
         
         cleaned_stft = cleaned_magnitude * np.exp(1j * phase)
-        cleaned_audio = librosa.istft(cleaned_stft)
+        cleaned_audio = librosa.istft(cleaned_stft, hop_length=self.hop_length, length=len(audio))
         
         return cleaned_audio
     
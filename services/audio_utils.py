@@ -9,4 +9,30 @@ def convert_to_wav_mono(input_path):
         output_path, "-y"
     ]
     subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return output_path
\ No newline at end of file
+    return output_path
+
+def iter_blocks(audio, blocksize, overlap=0):
+    """
+    Yield consecutive blocks of a 1-D array, each sharing `overlap` samples
+    with the previous one (same layout as soundfile.blocks).
+    """
+    step = blocksize - overlap
+    for start in range(0, max(len(audio) - overlap, 1), step):
+        yield audio[start:start + blocksize]
+
+
+def stitch_blocks(blocks, overlap=0):
+    """
+    Inverse of iter_blocks for processed blocks of unchanged length.
+    Each shared region is split in half so both sides keep some context.
+    """
+    head = overlap // 2
+    tail = overlap - head
+    prev, prev_start = None, 0
+    for block in blocks:
+        if prev is not None:
+            yield prev[prev_start:len(prev) - tail]
+            prev_start = head
+        prev = block
+    if prev is not None:
+        yield prev[prev_start:]
@@ -1,6 +1,7 @@
 
 import os
 import torch
+import streamlit as st
 from pyannote.audio import Pipeline
 from dotenv import load_dotenv
 
@@ -12,20 +13,31 @@ if not HUGGINGFACE_TOKEN:
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-try:
-    pipeline = Pipeline.from_pretrained(
-        "pyannote/speaker-diarization-3.1",
-        use_auth_token=HUGGINGFACE_TOKEN
-    )
-    pipeline.to(device)
-except Exception as e:
-    raise RuntimeError(
-        f"Failed to load diarization pipeline. Check Hugging Face token and model access.\nError: {e}"
-    )
+@st.cache_resource
+def get_diarization_pipeline():
+    """Load the pyannote pipeline once per process."""
+    try:
+        pipeline = Pipeline.from_pretrained(
+            "pyannote/speaker-diarization-3.1",
+            use_auth_token=HUGGINGFACE_TOKEN
+        )
+        pipeline.to(device)
+    except Exception as e:
+        raise RuntimeError(
+            f"Failed to load diarization pipeline. Check Hugging Face token and model access.\nError: {e}"
+        )
+    return pipeline
 
 def diarize_audio(file_path: str):
     """Perform speaker diarization and return segments."""
-    diarization = pipeline(file_path)
+    pipeline = get_diarization_pipeline()
+    if device.type == "cuda":
+        # fp16 autocast for the segmentation/embedding nets (Tensor Cores)
+        with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.float16):
+            diarization = pipeline(file_path)
+    else:
+        with torch.inference_mode():
+            diarization = pipeline(file_path)
     segments = []
     for turn, _, speaker in diarization.itertracks(yield_label=True):
         segments.append({
@@ -5,12 +5,16 @@ from scipy.spatial.distance import pdist, squareform
 from sklearn.cluster import KMeans
 from scipy import signal
 
+from services.audio_utils import iter_blocks, stitch_blocks
+
 class SpeakerSeparator:
-    def __init__(self, sample_rate, num_speakers=2):
+    def __init__(self, sample_rate, num_speakers=2, block_duration=30.0, overlap_duration=1.0):
         self.sample_rate = sample_rate
         self.num_speakers = num_speakers
         self.hop_length = 512
         self.n_fft = 2048
+        self.block_size = int(block_duration * sample_rate)
+        self.overlap = int(overlap_duration * sample_rate)
     
     def extract_features(self, audio):
         mfcc = librosa.feature.mfcc(
@@ -71,7 +75,10 @@ class SpeakerSeparator:
         labels = kmeans.fit_predict(features)
         
         return labels
-    def separate_speakers(self, audio):
+    def separate_speakers(self, audio, prior_turns=None):
+        if prior_turns:
+            return self.separate_by_turns(audio, prior_turns)
+
         segments, segment_indices = self.segment_audio(audio, segment_duration=0.25)
 
         if len(segments) == 0:
@@ -117,7 +124,31 @@ class SpeakerSeparator:
 
         return speaker_audio
 
+    def separate_by_turns(self, audio, turns):
+        # Known diarization boundaries: extract each speaker by time, no clustering
+        speaker_audio = {}
+        for t in turns:
+            start = max(0, int(t["start"] * self.sample_rate))
+            end = min(len(audio), int(np.ceil(t["end"] * self.sample_rate)))
+            if end <= start:
+                continue
+            track = speaker_audio.setdefault(t["speaker"], np.zeros_like(audio))
+            track[start:end] = audio[start:end]
+
+        return dict(sorted(speaker_audio.items()))
+
     def strong_mask(self, original, speaker):
+        # mask in overlapping windows so only one block's STFT is alive at a time
+        masked_blocks = (
+            self._strong_mask_block(orig_block, spk_block)
+            for orig_block, spk_block in zip(
+                iter_blocks(original, self.block_size, self.overlap),
+                iter_blocks(speaker, self.block_size, self.overlap),
+            )
+        )
+        return np.concatenate(list(stitch_blocks(masked_blocks, self.overlap)))
+
+    def _strong_mask_block(self, original, speaker):
         stft_orig = librosa.stft(original, n_fft=self.n_fft, hop_length=self.hop_length)
         stft_spk = librosa.stft(speaker, n_fft=self.n_fft, hop_length=self.hop_length)
 
@@ -127,8 +158,8 @@ class SpeakerSeparator:
         mask = (mag_spk > (mag_orig * 0.25)).astype(float)  # binary mask style
 
         masked = stft_orig * mask
-        enhanced = librosa.istft(masked, hop_length=self.hop_length)
-        return enhanced[:len(original)]
+        enhanced = librosa.istft(masked, hop_length=self.hop_length, length=len(original))
+        return enhanced
 
 
     
@@ -2,53 +2,179 @@ from services.diarization_service import diarize_audio
 from services.audio_utils import convert_to_wav_mono
 from services.align_service import assign_speaker_to_words, group_words_to_turns
 
-import whisper
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 import torch
-import tempfile
+import numpy as np
+import streamlit as st
+import soundfile as sf
 import os
 import datetime
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
-model = whisper.load_model("base", device=device)
+
+# Whisper clips are capped at 30 s
+ASR_BATCH_SIZE = 8
+MAX_CLIP_SECONDS = 30.0
+
+
+@st.cache_resource
+def get_whisper_model():
+    """Load the quantized CTranslate2 Whisper model once per process."""
+    compute_type = "int8_float16" if device == "cuda" else "int8"
+    return WhisperModel("base", device=device, compute_type=compute_type)
+
+
+def _speaker_regions(speaker_segments):
+    """
+    Flatten diarized turns into non-overlapping, time-ordered speaker regions.
+    pyannote reports overlapped speech as overlapping turns; each overlap is
+    cut out of the later turn so its audio is transcribed only once.
+    """
+    regions = []
+    covered_until = float("-inf")
+    for seg in sorted(speaker_segments, key=lambda s: s["start"]):
+        start = max(seg["start"], covered_until)
+        if seg["end"] > start:
+            regions.append({"start": start, "end": seg["end"], "speaker": seg["speaker"]})
+        covered_until = max(covered_until, seg["end"])
+    return regions
+
+
+def _speaker_clips(regions, max_len=MAX_CLIP_SECONDS):
+    """Split non-overlapping speaker regions into Whisper-sized clips, each tagged with its speaker."""
+    clips = []
+    for seg in regions:
+        start = seg["start"]
+        while start < seg["end"]:
+            end = min(seg["end"], start + max_len)
+            clips.append({"start": start, "end": end, "speaker": seg["speaker"]})
+            start = end
+    return clips
+
+
+def _label_words_by_region(starts, ends, regions):
+    """
+    Speaker of the region containing each word's midpoint, or None outside every region.
+    Regions must be disjoint and time-ordered, as returned by _speaker_regions.
+    """
+    if not regions:
+        return [None] * len(starts)
+    region_start = np.array([r["start"] for r in regions], dtype=float)
+    region_end = np.array([r["end"] for r in regions], dtype=float)
+    mid = (np.asarray(starts, dtype=float) + np.asarray(ends, dtype=float)) / 2
+    idx = np.searchsorted(region_start, mid, side="right") - 1
+    safe = np.clip(idx, 0, len(regions) - 1)
+    inside = (idx >= 0) & (mid <= region_end[safe])
+    return [regions[j]["speaker"] if ok else None for j, ok in zip(safe, inside)]
+
+
+def _run_asr(model, wav_path, clips):
+    """
+    Batch-transcribe the given clips with word timestamps; drains the lazy generator.
+    BatchedInferencePipeline may join consecutive clips into one 30 s context, so
+    each speaker's clips go through their own call to keep contexts single-speaker.
+    """
+    batched = BatchedInferencePipeline(model)
+    if not clips:
+        # no diarization: let faster-whisper's VAD pick the speech regions
+        segments, _info = batched.transcribe(
+            wav_path, batch_size=ASR_BATCH_SIZE, word_timestamps=True
+        )
+        return list(segments)
+
+    results = []
+    for speaker in dict.fromkeys(c["speaker"] for c in clips):
+        speaker_clips = [
+            {"start": c["start"], "end": c["end"]} for c in clips if c["speaker"] == speaker
+        ]
+        segments, _info = batched.transcribe(
+            wav_path,
+            clip_timestamps=speaker_clips,
+            batch_size=ASR_BATCH_SIZE,
+            word_timestamps=True,
+        )
+        results.extend(segments)
+    return results
+
 
 SAVE_ROOT = Path("saved_transcription")
 SAVE_ROOT.mkdir(exist_ok=True)
 
 def extract_audio_segment(input_path, start, end, output_path):
     """Extract a specific audio segment (in seconds)."""
+    try:
+        # frame-indexed slice: cost is linear in segment length, not file length
+        with sf.SoundFile(input_path) as f:
+            f.seek(int(start * f.samplerate))
+            data = f.read(int((end - start) * f.samplerate), dtype="float32")
+            sf.write(output_path, data, f.samplerate, subtype=f.subtype)
+        return
+    except sf.LibsndfileError:
+        pass
+
+    # non-libsndfile input: seek before -i so ffmpeg doesn't decode from file start
     command = [
         "ffmpeg",
         "-y",
-        "-i",
-        input_path,
         "-ss",
         str(start),
-        "-to",
-        str(end),
+        "-i",
+        input_path,
+        "-t",
+        str(end - start),
         "-c",
         "copy",
         output_path,
     ]
     subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-def _transcribe_from_path(tmp_path: str):
-    """Internal: main pipeline given a temp wav path."""
-    wav_path = convert_to_wav_mono(tmp_path)
-    result = model.transcribe(wav_path, word_timestamps=True)
+def _transcribe_from_path(audio_path: str):
+    """Internal: main pipeline given an on-disk audio path."""
+    wav_path = convert_to_wav_mono(audio_path)
+    model = get_whisper_model()
 
-    # collect word-level timestamps
-    words = []
-    for seg in result["segments"]:
-        for w in seg.get("words", []):
-            words.append({"word": w["word"], "start": w["start"], "end": w["end"]})
-
-    # diarization
+    # diarization first, then transcribe each speaker's clips in batches
     speaker_segments = diarize_audio(wav_path)
-
-    # alignment: assign speaker labels to each word
-    aligned = assign_speaker_to_words(words, speaker_segments)
+    regions = _speaker_regions(speaker_segments)
+    asr_segments = _run_asr(model, wav_path, _speaker_clips(regions))
+
+    # collect word-level timestamps as parallel arrays (file timeline)
+    n = sum(len(seg.words or []) for seg in asr_segments)
+    starts = np.empty(n)
+    ends = np.empty(n)
+    words = [None] * n
+    i = 0
+    for seg in asr_segments:
+        for w in seg.words or []:
+            starts[i] = w.start
+            ends[i] = w.end
+            words[i] = w.word
+            i += 1
+
+    # per-speaker passes come back grouped by speaker; restore time order
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    ends = ends[order]
+    words = [words[i] for i in order]
+
+    # label by the speaker region under each word; words outside every region
+    # (e.g. the VAD path with no diarization) fall back to time alignment
+    speakers = _label_words_by_region(starts, ends, regions)
+    missing = [i for i in range(n) if speakers[i] is None]
+    if missing:
+        fallback = assign_speaker_to_words(
+            starts[missing], ends[missing], [words[i] for i in missing], speaker_segments
+        )
+        for i, w in zip(missing, fallback):
+            speakers[i] = w["speaker"]
+
+    aligned = [
+        {"speaker": speakers[i], "start": float(starts[i]), "end": float(ends[i]), "text": words[i]}
+        for i in range(n)
+    ]
     turns = group_words_to_turns(aligned)
 
     # session folder under saved_transcription/
@@ -62,28 +188,33 @@ def _transcribe_from_path(tmp_path: str):
         for t in turns:
             f.write(f"{t['speaker']}: {t['text']}\n\n")
 
-    # save each turn's text + audio
-    for idx, t in enumerate(turns, start=1):
-        sp_dir = session_dir / t["speaker"]
-        sp_dir.mkdir(exist_ok=True)
+    # save each turn's text + audio; segment extraction is independent per turn
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as ex:
+        futures = []
+        for idx, t in enumerate(turns, start=1):
+            sp_dir = session_dir / t["speaker"]
+            sp_dir.mkdir(exist_ok=True)
 
-        txt_path = sp_dir / f"line_{idx:02d}.txt"
-        with open(txt_path, "w", encoding="utf-8") as f:
-            f.write(t["text"])
+            txt_path = sp_dir / f"line_{idx:02d}.txt"
+            with open(txt_path, "w", encoding="utf-8") as f:
+                f.write(t["text"])
 
-        audio_path = sp_dir / f"line_{idx:02d}.wav"
-        extract_audio_segment(wav_path, t["start"], t["end"], str(audio_path))
+            audio_path = sp_dir / f"line_{idx:02d}.wav"
+            futures.append(
+                ex.submit(extract_audio_segment, wav_path, t["start"], t["end"], str(audio_path))
+            )
 
-        # for Streamlit we store the real filesystem path
-        t["audio_path"] = str(audio_path)
+            # for Streamlit we store the real filesystem path
+            t["audio_path"] = str(audio_path)
+
+        for fut in futures:
+            fut.result()
 
     # create drama-style script
     script_lines = [f"{t['speaker']}: {t['text']}" for t in turns]
     drama_script = "\n\n".join(script_lines)
 
-    # cleanup temp wavs
-    if os.path.exists(tmp_path):
-        os.remove(tmp_path)
+    # cleanup the mono conversion; the caller owns audio_path
     if os.path.exists(wav_path):
         os.remove(wav_path)
 
@@ -95,13 +226,9 @@ def _transcribe_from_path(tmp_path: str):
         "session_dir": str(session_dir),
     }
 
-def transcribe_streamlit(file_bytes: bytes):
+def transcribe_streamlit(audio_path: str):
     """
     Entry point used by Streamlit.
-    Takes raw file bytes and returns transcription + diarization result.
+    Takes the path of the already-saved upload and returns transcription + diarization result.
     """
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-        tmp.write(file_bytes)
-        tmp_path = tmp.name
-
-    return _transcribe_from_path(tmp_path)
+    return _transcribe_from_path(audio_path)